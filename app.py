@@ -1,14 +1,17 @@
 from db import *
-from flask import Flask, request
-import json
+from flask import Flask, Response, request, stream_with_context
+from functools import lru_cache, partial
+import orjson
+import os
 from sqlalchemy import update
+from sqlalchemy.orm import joinedload, selectinload
 
 app = Flask(__name__)
 db_filename = "hack.db"
 
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
+app.config["SQLALCHEMY_ECHO"] = os.environ.get("SQLALCHEMY_ECHO", "false").lower() == "true"
 
 db.init_app(app)
 with app.app_context():
@@ -20,105 +23,113 @@ def success_response(data, code=200):
     """
     Generalized success response
     """
-    return json.dumps(data), code
+    return Response(orjson.dumps(data), status=code, mimetype="application/json")
 
 
 def failure_response(message, code=404):
     """
     Generalized failure response
     """
-    return json.dumps({"error": message}), code
+    return Response(orjson.dumps({"error": message}), status=code, mimetype="application/json")
 
 
 # General Testing Routes
-@app.route("/test/users/")
-def get_all_users():
-    """
-    Testing Endpoint for getting all users
-    """
-    users = [user.serialize() for user in User.query.all()]
-    return success_response({"users": users})
+# serialized table dumps, keyed by name and stored with the table versions they were built from
+table_dumps = {}
+# dumps larger than this are streamed without being kept, so memory stays bounded
+MAX_CACHED_DUMP_BYTES = 1024 * 1024
 
 
-@app.route("/test/users/", methods=["DELETE"])
-def delete_user_table():
-    """
-    Testing Endpoint for deleting the user table
+def get_all_rows(model, serializer, name, tables, options):
     """
-    User.__table__.drop(db.engine)
-    return success_response("Table Deleted")
-
+    Testing Endpoint for getting all rows of a table
+    options are loader options for the relationships the serializer reads
+    Rows are loaded in batches and streamed out as they are serialized
+    Each batch is its own short query, so no statement stays open (holding
+    SQLite's lock) while the response is being sent
 
-@app.route("/test/songs/")
-def get_all_songs():
+    If tables is not empty, the finished dump is cached until one of them changes
+    Cached dumps are buffered while streaming, up to MAX_CACHED_DUMP_BYTES
     """
-    Testing Endpoint for getting all songs
-    """
-    songs = [song.simple_serialize() for song in Song.query.all()]
-    return success_response({"songs": songs})
+    versions = tuple(table_versions[table] for table in tables)
+    cached = table_dumps.get(name)
 
+    if tables and cached is not None and cached[0] == versions:
+        return Response(cached[1], mimetype="application/json")
 
-@app.route("/test/songs/", methods=["DELETE"])
-def delete_song_table():
-    """
-    Testing Endpoint for deleting the songs table
-    """
-    Song.__table__.drop(db.engine)
-    return success_response("Table Deleted")
+    def fetch_batch(last_id):
+        return model.query.options(*options).filter(model.id > last_id).order_by(model.id).limit(500).all()
 
+    # fetch the first batch before streaming, so database errors fail the request before any output
+    first_batch = fetch_batch(0)
 
-@app.route("/test/playlists/")
-def get_all_playlists():
-    """
-    Testing Endpoint for getting all playlists
-    """
-    playlists = [playlist.serialize() for playlist in Playlist.query.all()]
-    return success_response({"playlists": playlists})
+    def rows():
+        batch = first_batch
+        while batch:
+            yield from batch
+            if len(batch) < 500:
+                return
+            batch = fetch_batch(batch[-1].id)
 
+    def chunks():
+        yield b"{" + orjson.dumps(name) + b":["
+        for i, row in enumerate(rows()):
+            yield (b"," if i else b"") + orjson.dumps(getattr(row, serializer)())
+        yield b"]}"
 
-@app.route("/test/playlists/", methods=["DELETE"])
-def delete_playlist_table():
-    """
-    Testing Endpoint for deleting the playlists table
-    """
-    Playlist.__table__.drop(db.engine)
-    return success_response("Table Deleted")
+    def stream():
+        kept = [] if tables else None
+        size = 0
+        for chunk in chunks():
+            yield chunk
+            if kept is not None:
+                size += len(chunk)
+                kept = kept if size <= MAX_CACHED_DUMP_BYTES else None
+            if kept is not None:
+                kept.append(chunk)
 
+        if kept is not None:
+            table_dumps[name] = (versions, b"".join(kept))
+        elif tables:
+            table_dumps.pop(name, None)
 
-@app.route("/test/assets/")
-def get_all_assets():
-    """
-    Testing Endpoint for getting all assets
-    """
-    assets = [asset.test_serialize() for asset in Asset.query.all()]
-    return success_response({"assets": assets})
+    return Response(stream_with_context(stream()), mimetype="application/json")
 
 
-@app.route("/test/assets/", methods=["DELETE"])
-def delete_asset_table():
+def delete_table(model):
     """
-    Testing Endpoint for deleting the asset table
+    Testing Endpoint for deleting a table
     """
-    Asset.__table__.drop(db.engine)
+    model.__table__.drop(db.engine)
+    bump_table_versions([model.__tablename__])
     return success_response("Table Deleted")
 
 
-@app.route("/test/images/")
-def get_all_images():
+def register_testing_routes():
     """
-    Testing Endpoint for getting all images
+    Registers the GET and DELETE testing routes for every table
     """
-    images = [image.simple_serialize() for image in Img.query.all()]
-    return success_response({"images": images})
+    for model, serializer, name, tables, options in [
+        (User, "serialize", "users", ("user", "playlist", "image"), (selectinload(User.playlists),)),
+        (Song, "simple_serialize", "songs", ("song",), ()),
+        (Playlist, "serialize", "playlists", (), ()),
+        (Asset, "test_serialize", "assets", (), ()),
+        (Img, "simple_serialize", "images", (), ())
+    ]:
+        app.add_url_rule(
+            f"/test/{name}/",
+            endpoint=f"get_all_{name}",
+            view_func=partial(get_all_rows, model, serializer, name, tables, options)
+        )
+        app.add_url_rule(
+            f"/test/{name}/",
+            endpoint=f"delete_{name}_table",
+            view_func=partial(delete_table, model),
+            methods=["DELETE"]
+        )
 
 
-@app.route("/test/images/", methods=["DELETE"])
-def delete_image_table():
-    """
-    Testing Endpoint for deleting the images table
-    """
-    Img.__table__.drop(db.engine)
-    return success_response("Table Deleted")
+register_testing_routes()
 
 
 # App Routes
@@ -132,7 +143,7 @@ def create_new_user():
     The frontend should send a json with these keys and value types:
     {"username": <str>}
     """
-    body = json.loads(request.data)
+    body = orjson.loads(request.data)
     username = body.get("username")
 
     if username is None:
@@ -154,7 +165,7 @@ def add_song_to_database():
     The fronted should send a json with these keys and value types:
     {"title": <str>, "artist": <str>, "bpm": <int>, "link": <str>}
     """
-    body = json.loads(request.data)
+    body = orjson.loads(request.data)
     title = body.get("title")
     artist = body.get("artist")
     bpm = body.get("bpm")
@@ -163,11 +174,14 @@ def add_song_to_database():
     if title is None or artist is None or bpm is None or link is None:
         return failure_response("Please input all requested data", 400)
 
-    new_song = Song(title=title, artist=artist, bpm=bpm, link=link)
+    exists = db.session.query(Song.id).filter_by(
+        title=title, artist=artist, bpm=bpm, link=link
+    ).first() is not None
 
-    if new_song.exists_serialize() in [song.exists_serialize() for song in Song.query.all()]:
+    if exists:
         return failure_response("Song already exists", 401)
 
+    new_song = Song(title=title, artist=artist, bpm=bpm, link=link)
     db.session.add(new_song)
     db.session.commit()
     return success_response(new_song.simple_serialize(), 201)
@@ -182,19 +196,17 @@ def get_songs_bpm():
     The frontend should send a json with these keys and value types:
     {"upper_bpm": <int>, "lower_bpm": <int>}
     """
-    body = json.loads(request.data)
+    body = orjson.loads(request.data)
     lower_bpm = body.get("lower_bpm")
     upper_bpm = body.get("upper_bpm")
 
     if lower_bpm is None or upper_bpm is None:
         return failure_response("Please input a bpm range", 400)
 
-    all_songs = [song.simple_serialize() for song in Song.query.all()]
-    filtered_songs = []
-
-    for song in all_songs:
-        if song["bpm"] in range(lower_bpm, upper_bpm + 1):
-            filtered_songs.append(song)
+    filtered_songs = [
+        song.simple_serialize()
+        for song in Song.query.filter(Song.bpm >= lower_bpm, Song.bpm <= upper_bpm).order_by(Song.id)
+    ]
 
     if not filtered_songs:
         return failure_response("No songs in this range were found", 400)
@@ -211,14 +223,29 @@ def get_user_playlists(user_id):
     This is because the UI would get crowded if the songs were included. The songs will
     only be included in the route to get a specific playlist.
     """
-    user = User.query.filter_by(id=user_id).first()
+    user = User.query.get(user_id)
 
     if user is None:
         return failure_response("User not found")
 
-    playlists = [playlist.simple_serialize() for playlist in Playlist.query.filter_by(user_id=user_id)]
+    versions = (table_versions["playlist"], table_versions["image"])
+    return Response(serialize_user_playlists(user_id, versions), mimetype="application/json")
+
+
+@lru_cache(maxsize=32)
+def serialize_user_playlists(user_id, versions):
+    """
+    Serializes a user's playlists for get_user_playlists
+
+    versions holds the current playlist and image table versions, so cached
+    results are only reused while neither table has changed
+    """
+    playlists = [
+        playlist.simple_serialize()
+        for playlist in Playlist.query.options(joinedload(Playlist.image)).filter_by(user_id=user_id)
+    ]
 
-    return success_response({"playlists": playlists})
+    return orjson.dumps({"playlists": playlists})
 
 
 @app.route("/users/<int:user_id>/playlists/", methods=["POST"])
@@ -229,12 +256,12 @@ def create_new_playlist(user_id):
     The frontend should send a json with these keys and value types:
     {"playlist_name": <str>}
     """
-    user = User.query.filter_by(id=user_id).first()
+    user = User.query.get(user_id)
 
     if user is None:
         return failure_response("User not found")
 
-    body = json.loads(request.data)
+    body = orjson.loads(request.data)
     playlist_name = body.get("playlist_name")
 
     if playlist_name is None:
@@ -252,7 +279,11 @@ def get_specific_playlist(playlist_id):
     """
     Endpoint for getting a specific user's playlist by its id
     """
-    playlist = Playlist.query.filter_by(id=playlist_id).first()
+    playlist = Playlist.query.options(
+        selectinload(Playlist.songs),
+        joinedload(Playlist.user),
+        joinedload(Playlist.image)
+    ).get(playlist_id)
 
     if playlist is None:
         return failure_response("Playlist not found")
@@ -265,7 +296,7 @@ def delete_playlist(playlist_id):
     """
     Endpoint for deleting a user's playlist by its id
     """
-    playlist = Playlist.query.filter_by(id=playlist_id).first()
+    playlist = Playlist.query.get(playlist_id)
 
     if playlist is None:
         return failure_response("Playlist not found")
@@ -282,17 +313,24 @@ def add_song_to_playlist(playlist_id, song_id):
     """
     Endpoint for adding a song to a playlist
     """
-    playlist = Playlist.query.filter_by(id=playlist_id).first()
+    playlist = Playlist.query.get(playlist_id)
 
     if playlist is None:
         return failure_response("Playlist not found")
 
-    song = Song.query.filter_by(id=song_id).first()
+    song = Song.query.get(song_id)
 
     if song is None:
         return failure_response("Song not found")
 
-    playlist.songs.append(song)
+    in_playlist = db.session.query(association_table).filter_by(
+        playlist_id=playlist_id, song_id=song_id
+    ).first()
+
+    if in_playlist is not None:
+        return failure_response("Song already in playlist", 400)
+
+    db.session.execute(association_table.insert().values(playlist_id=playlist_id, song_id=song_id))
     db.session.commit()
     return success_response(song.simple_serialize())
 
@@ -302,22 +340,28 @@ def remove_song_from_playlist(playlist_id, song_id):
     """
     Endpoint for removing a song from a playlist
     """
-    playlist = Playlist.query.filter_by(id=playlist_id).first()
+    playlist = Playlist.query.get(playlist_id)
 
     if playlist is None:
         return failure_response("Playlist not found")
 
-    song = Song.query.filter_by(id=song_id).first()
+    song = Song.query.get(song_id)
 
     if song is None:
         return failure_response("Song not found")
 
-    try:
-        playlist.songs.index(song)
-    except ValueError:
+    in_playlist = db.session.query(association_table).filter_by(
+        playlist_id=playlist_id, song_id=song_id
+    ).first()
+
+    if in_playlist is None:
         return failure_response("Song not in playlist", 400)
 
-    playlist.songs.remove(song)
+    db.session.execute(
+        association_table.delete().where(
+            (association_table.c.playlist_id == playlist_id) & (association_table.c.song_id == song_id)
+        )
+    )
     db.session.commit()
 
     return success_response(song.simple_serialize())
@@ -328,7 +372,7 @@ def get_song_from_playlist(song_id):
     """
     Endpoint for getting/playing a song with give id
     """
-    song = Song.query.filter_by(id=song_id).first()
+    song = Song.query.get(song_id)
 
     if song is None:
         return failure_response("Song not found")
@@ -342,17 +386,19 @@ def upload_playlist_image(playlist_id):
     Endpoint for uploading an image to AWS given a base64 image file
     It will then be uploaded to AWS to be returned when
     a request that returns a playlist is sent.
+    The upload happens in the background, so 202 is returned with the
+    image link before the file is available on AWS.
 
     The frontend should send a json with these keys and value types:
     {"image_data": <str>}
     Note: The frontend should first convert an image file to a base64 str, then send that
     """
-    playlist = Playlist.query.filter_by(id=playlist_id).first()
+    playlist = Playlist.query.get(playlist_id)
 
     if playlist is None:
         return failure_response("Playlist not found")
 
-    body = json.loads(request.data)
+    body = orjson.loads(request.data)
     image_data = body.get("image_data")
 
     if image_data is None:
@@ -360,13 +406,12 @@ def upload_playlist_image(playlist_id):
 
     asset = Asset(image_data=image_data)
     db.session.add(asset)
-    db.session.commit()
 
-    image = Img(link=asset.serialize()["url"], playlist_id=playlist_id)
+    image = Img(link=asset.url, playlist=playlist)
     db.session.add(image)
     db.session.commit()
 
-    return success_response(image.serialize(), 201)
+    return success_response(image.serialize(), 202)
 
 
 @app.route("/playlists/<int:playlist_id>/images/", methods=["DELETE"])
@@ -376,18 +421,21 @@ def remove_playlist_image(playlist_id):
     The image will not be deleted from AWS, but it will be deleted
     from both the Img and Asset tables.
     """
-    playlist = Playlist.query.filter_by(id=playlist_id).first()
+    playlist = Playlist.query.get(playlist_id)
 
     if playlist is None:
         return failure_response("Playlist not found")
 
+    if playlist.image_id is None:
+        return failure_response("There is no image associated with this playlist")
+
     # remove from Img
     image_id = playlist.image_id
-    image = Img.query.filter_by(id=image_id).first()
+    image = Img.query.get(image_id)
 
     # remove from Asset
     asset_id = playlist.image_id
-    asset = Asset.query.filter_by(id=asset_id).first()
+    asset = Asset.query.get(asset_id)
 
     if image is None:
         return failure_response("There is no image associated with this playlist")
@@ -4,29 +4,73 @@ import os
 
 import bcrypt
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import update
+from sqlalchemy import event, update
+from sqlalchemy.orm import Session
 
 import base64
 import boto3
-from mimetypes import guess_type, guess_extension
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, count
 from PIL import Image
-import random
-import re
-import string
+import secrets
 from io import BytesIO
 
 EXTENSIONS = ["png", "gif", "jpg", "jpeg"]
-BASE_DIR = os.getcwd()
 S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
 S3_BASE_URL = f"https://{S3_BUCKET_NAME}.s3.us-east-1.amazonaws.com"
+S3_CLIENT = boto3.client("s3") if S3_BUCKET_NAME is not None else None
+
+# S3 uploads run in the background so requests don't wait on AWS
+upload_executor = ThreadPoolExecutor(max_workers=4)
 
 db = SQLAlchemy()
 
+# version of each table, changed whenever a commit writes to it
+# used as a cache key by routes that cache their serialized responses
+table_versions = defaultdict(int)
+version_counter = count(1)
+
+
+def bump_table_versions(tables):
+    """
+    Gives each of the given tables a new version
+    """
+    for table in tables:
+        table_versions[table] = next(version_counter)
+
+
+@event.listens_for(Session, "after_flush")
+def record_changed_tables(session, flush_context):
+    """
+    Remembers which tables a flush wrote to, until the transaction ends
+    """
+    changed_tables = session.info.setdefault("changed_tables", set())
+    for obj in chain(session.new, session.dirty, session.deleted):
+        changed_tables.add(obj.__tablename__)
+
+
+@event.listens_for(Session, "after_commit")
+def commit_changed_tables(session):
+    """
+    Bumps the versions of the tables written to once their changes are committed
+    """
+    bump_table_versions(session.info.pop("changed_tables", ()))
+
+
+@event.listens_for(Session, "after_rollback")
+def discard_changed_tables(session):
+    """
+    Forgets the tables written to by a rolled back transaction
+    """
+    session.info.pop("changed_tables", None)
+
 # association table
 association_table = db.Table(
     "playlist_song_association",
     db.Column("playlist_id", db.Integer, db.ForeignKey("playlist.id")),
-    db.Column("song_id", db.Integer, db.ForeignKey("song.id"))
+    db.Column("song_id", db.Integer, db.ForeignKey("song.id"), index=True),
+    db.PrimaryKeyConstraint("playlist_id", "song_id")
 )
 
 
@@ -43,7 +87,7 @@ class User(db.Model):
     username = db.Column(db.String, nullable=False)
 
     # playlist relationship
-    playlists = db.relationship("Playlist", cascade="delete")
+    playlists = db.relationship("Playlist", back_populates="user", cascade="delete")
 
     def __init__(self, **kwargs):
         """
@@ -85,14 +129,14 @@ class Playlist(db.Model):
     playlist_name = db.Column(db.String(), nullable=False)
 
     # user relationship
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
     user = db.relationship("User", back_populates="playlists")
 
     # song relationship
     songs = db.relationship("Song", secondary=association_table, back_populates="playlists")
 
     # image relationship
-    image_id = db.Column(db.Integer, db.ForeignKey("image.id"))
+    image_id = db.Column(db.Integer, db.ForeignKey("image.id"), index=True)
     image = db.relationship(
         "Img",
         back_populates="playlist",
@@ -149,6 +193,10 @@ class Song(db.Model):
     Has a Many-to-Many relationship with Playlist
     """
     __tablename__ = "song"
+    __table_args__ = (
+        db.UniqueConstraint("title", "artist", "bpm", "link", name="uq_song"),
+        db.Index("ix_song_bpm", "bpm"),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.String, nullable=False)
     artist = db.Column(db.String, nullable=False)
@@ -192,17 +240,6 @@ class Song(db.Model):
             "link": self.link
         }
 
-    def exists_serialize(self):
-        """
-        Serializes a song object without id (for use in add_song_to_database())
-        """
-        return {
-            "title": self.title,
-            "artist": self.artist,
-            "bpm": self.bpm,
-            "link": self.link
-        }
-
 
 # Images classes
 class Img(db.Model):
@@ -226,8 +263,7 @@ class Img(db.Model):
         Initializes an image object
         """
         self.link = kwargs.get("link")
-        self.playlist_id = kwargs.get("playlist_id")
-        self.playlist = Playlist.query.filter_by(id=self.playlist_id).first()
+        self.playlist = kwargs.get("playlist")
 
     def serialize(self):
         """
@@ -258,6 +294,7 @@ class Asset(db.Model):
     base_url = db.Column(db.String, nullable=False)
     salt = db.Column(db.String, nullable=False)
     extension = db.Column(db.String, nullable=False)
+    url = db.Column(db.String, nullable=False)
     width = db.Column(db.Integer, nullable=False)
     height = db.Column(db.Integer, nullable=False)
     created_at = db.Column(db.DateTime, nullable=False)
@@ -273,8 +310,8 @@ class Asset(db.Model):
         Serializes an Asset object
         """
         return {
-            "url": f"{self.base_url}/{self.salt}.{self.extension}",
-            "created_at": str(self.created_at)
+            "url": self.url,
+            "created_at": self.created_at
         }
 
     def test_serialize(self):
@@ -283,8 +320,8 @@ class Asset(db.Model):
         """
         return {
             "id": self.id,
-            "url": f"{self.base_url}/{self.salt}.{self.extension}",
-            "created_at": str(self.created_at)
+            "url": self.url,
+            "created_at": self.created_at
         }
 
     def create(self, image_data):
@@ -292,57 +329,56 @@ class Asset(db.Model):
         Given an image in base64 encoding, does the following:
         1. Rejects the image if it is not a supported file type
         2. Generate a random string for the image filename
-        3. Decodes the image and attempts to upload it to AWS
+        3. Decodes the image and queues its upload to AWS
         """
         try:
-            ext = guess_extension(guess_type(image_data)[0])[1:]
-            if ext not in EXTENSIONS:
+            # data URIs look like "data:image/<ext>;base64,<data>"
+            header, _, img_str = image_data.partition(",")
+            # media types are case-insensitive
+            ext = header.partition(";")[0].split("/", 1)[-1].lower()
+            if not header.lower().startswith("data:image/") or ext not in EXTENSIONS:
                 raise Exception(f"Extension {ext} is not valid.")
 
-            salt = "".join(
-                random.SystemRandom().choice(
-                    string.ascii_uppercase + string.digits
-                )
-                for _ in range(16)
-            )
+            salt = secrets.token_hex(8).upper()
 
-            img_str = re.sub("^data:image/.+;base64,", "", image_data)
             img_data = base64.b64decode(img_str)
-            img = Image.open(BytesIO(img_data))
+            # only reads the header, the image itself is never decoded
+            width, height = Image.open(BytesIO(img_data)).size
 
             self.base_url = S3_BASE_URL
             self.salt = salt
             self.extension = ext
-            self.width = img.width
-            self.height = img.height
+            self.url = f"{self.base_url}/{self.salt}.{self.extension}"
+            self.width = width
+            self.height = height
             self.created_at = datetime.datetime.now()
 
             img_filename = f"{self.salt}.{self.extension}"
-            self.upload(img, img_filename)
+            upload_executor.submit(self.upload, img_data, img_filename)
 
         except Exception as e:
             print(f"Error when creating image: {e}")
 
-    def upload(self, img, img_filename):
+    def upload(self, img_data, img_filename):
         """
         Attempts to upload the image into the specified S3 bucket
+        Runs on upload_executor, so it must not touch any database state
         """
         try:
-            # save image into temporary location
-            img_temp_loc = f"{BASE_DIR}/{img_filename}"
-            img.save(img_temp_loc)
-
-            # upload image into S3 bucket
-            s3_client = boto3.client("s3")
-            s3_client.upload_file(img_temp_loc, S3_BUCKET_NAME, img_filename)
-
-            # make image public
-            s3_resource = boto3.resource("s3")
-            object_acl = s3_resource.ObjectAcl(S3_BUCKET_NAME, img_filename)
-            object_acl.put(ACL="public-read")
-
-            # remove image from temporary location
-            os.remove(img_temp_loc)
+            if S3_CLIENT is None:
+                raise Exception("S3_BUCKET_NAME is not set.")
+
+            # the extension was already validated against EXTENSIONS in create
+            ext = img_filename.rsplit(".", 1)[1]
+            content_type = "image/jpeg" if ext in ("jpg", "jpeg") else f"image/{ext}"
+
+            # upload the original bytes into S3 bucket and make them public
+            S3_CLIENT.upload_fileobj(
+                BytesIO(img_data),
+                S3_BUCKET_NAME,
+                img_filename,
+                ExtraArgs={"ACL": "public-read", "ContentType": content_type}
+            )
 
         except Exception as e:
             print(f"Error when uploading image: {e}")